@@ -11,95 +11,243 @@ Options:
   -h, --help            Print this message and exit.
   -v, --verbose         Produce more detailed output.
   --api-url=<api_url>   Request all world data from this Wurstmineberg Minecraft API instance. [Default: https://api.wurstmineberg.de]
+  --concurrency=<n>     Download up to this many chunks at the same time. [Default: 16]
+  --no-cache            Neither read nor write the on-disk cache of chunk data and the chunks overview.
   --start-coords=<x,z>  Start at these coordinates instead of the world spawn.
   --world=<world_name>  Request world data for this world. Defaults to the main world.
 """
 
 import collections
+import concurrent.futures
+import contextlib
 import docopt
 import enum
 import more_itertools
+import orjson
+import os
+import pathlib
 import requests
+import requests.adapters
+import tempfile
+import time
+import urllib.parse
 
 CACHE = {
     'all_chunks': None,
+    'biomes': None,
+    'biomes_by_name': None,
     'world': None
 }
 
-biomes_response = requests.get('https://assets.wurstmineberg.de/json/biomes.json')
-biomes_response.raise_for_status()
-Biome = enum.Enum('Biomes', {
-    biome_info['id']: (int(int_id), biome_info['adventuringTime'])
-    for int_id, biome_info in biomes_response.json()['biomes'].items()
-}, module=__name__)
+CACHE_DIR = pathlib.Path(os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache') / 'find-biomes'
+CHUNK_CACHE_MAX_AGE = 24 * 60 * 60 # seconds before a cached chunk is revalidated with the API
 
-def all_chunks_sorted_by_distance(arguments, start_x, start_z):
+SESSION = requests.Session()
+SESSION.headers['Connection'] = 'keep-alive'
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=32))
+
+def all_chunks(arguments):
     if CACHE['all_chunks'] is None:
         if arguments['--verbose']:
             print('[....] downloading chunks overview', end='\r', flush=True)
-        CACHE['all_chunks'] = api_json(arguments, '/v2/world/{world}/chunks/overview.json')
+        CACHE['all_chunks'] = api_json(arguments, get_world(arguments), '/v2/world/{world}/chunks/overview.json', max_age=0) # always revalidate, but skip the download if unchanged
         if arguments['--verbose']:
             print('[ ok ]')
+    return CACHE['all_chunks']['overworld']
+
+def all_chunks_sorted_by_distance(arguments, start_x, start_z):
     start_chunk_x = start_x // 16
     start_chunk_z = start_z // 16
-    result = collections.defaultdict(list)
-    for chunk in CACHE['all_chunks']['overworld']:
-        result[abs(chunk['x'] - start_chunk_x) + abs(chunk['z'] - start_chunk_z)].append(chunk)
-    for chunk_distance, chunks in sorted(result.items()):
-        for chunk in chunks:
+    rings = collections.defaultdict(list)
+    for chunk in all_chunks(arguments):
+        rings[abs(chunk['x'] - start_chunk_x) + abs(chunk['z'] - start_chunk_z)].append(chunk)
+    for chunk_distance in sorted(rings): # only the distances that occur, since a few far-off chunks can make the largest one huge
+        for chunk in rings[chunk_distance]:
             yield chunk_distance, chunk
 
-def api_json(arguments, path):
-    response = requests.get(arguments['--api-url'] + path.format(world=get_world(arguments)))
+def api_json(arguments, world, path, max_age=None):
+    url = arguments['--api-url'] + path.format(world=world)
+    if max_age is None or arguments['--no-cache']:
+        response = SESSION.get(url)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+    cache_path = CACHE_DIR / urllib.parse.quote(url, safe='')
+    headers = {}
+    try:
+        cached = orjson.loads(cache_path.read_bytes())
+    except (FileNotFoundError, ValueError):
+        pass
+    else:
+        if time.time() - cache_path.stat().st_mtime < max_age:
+            return cached['data']
+        if cached['etag'] is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached['lastModified'] is not None:
+            headers['If-Modified-Since'] = cached['lastModified']
+    response = SESSION.get(url, headers=headers)
     response.raise_for_status()
-    return response.json()
+    if response.status_code == requests.codes.not_modified:
+        with contextlib.suppress(OSError):
+            cache_path.touch()
+        return cached['data']
+    data = orjson.loads(response.content)
+    cache_f = None
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=CACHE_DIR, delete=False) as cache_f:
+            cache_f.write(orjson.dumps({
+                'data': data,
+                'etag': response.headers.get('ETag'),
+                'lastModified': response.headers.get('Last-Modified')
+            }))
+        os.replace(cache_f.name, cache_path)
+    except OSError: # the cache is only an optimization, so e.g. a read-only or full cache dir shouldn't fail the download
+        if cache_f is not None:
+            with contextlib.suppress(OSError):
+                os.unlink(cache_f.name)
+    return data
+
+def chunk_block_distance(chunk, start_x, start_z):
+    # the distance from the start coords to the closest block in the chunk
+    return max(0, 16 * chunk['x'] - start_x, start_x - 16 * chunk['x'] - 15) + max(0, 16 * chunk['z'] - start_z, start_z - 16 * chunk['z'] - 15)
+
+def chunk_could_improve(result, pending, min_block_distance):
+    # whether a chunk whose closest block is this far away could contain a closer block for any pending biome
+    return any(result[biome]['found_chunk_distance'] is None or min_block_distance < result[biome]['distance'] for biome in pending)
+
+def ring_could_improve(biome_result, chunk_distance):
+    # whether a chunk at this or a greater chunk distance could contain a block closer than the biome's best so far, since every block there is at least 16 * chunk_distance - 30 away
+    return biome_result['found_chunk_distance'] is None or biome_result['distance'] > max(0, 16 * chunk_distance - 30)
+
+def chunk_blocks(arguments, world, chunk):
+    while True:
+        try:
+            chunk_data = api_json(arguments, world, '/v2/world/{{world}}/chunks/overworld/chunk/{}/0/{}.json'.format(chunk['x'], chunk['z']), max_age=CHUNK_CACHE_MAX_AGE)
+        except requests.RequestException:
+            continue
+        break
+    result = collections.defaultdict(lambda: ([], [])) # biome name: (x coords, z coords) of its blocks in this chunk
+    for row in chunk_data[0]:
+        for block in row:
+            xs, zs = result[block['biome']]
+            xs.append(block['x'])
+            zs.append(block['z'])
+    biomes_by_name = get_biomes_by_name()
+    return {
+        biomes_by_name[biome_name]: coords
+        for biome_name, coords in result.items()
+        if biome_name in biomes_by_name
+    }
 
 def get_closest_coords(arguments, biomes, start_x, start_z):
-    chunks_by_distance = list(all_chunks_sorted_by_distance(arguments, start_x, start_z))
+    num_chunks = len(all_chunks(arguments))
+    chunks_by_distance = all_chunks_sorted_by_distance(arguments, start_x, start_z)
     result = {
-        biome: {'x': None, 'z': None, 'found_chunk_distance': None}
+        biome: {'x': None, 'z': None, 'distance': None, 'found_chunk_distance': None}
         for biome in biomes
     }
-    for i, (chunk_distance, chunk) in enumerate(chunks_by_distance):
-        if arguments['--verbose']:
-            progress = min(4, int(5 * i / len(chunks_by_distance)))
-            print('[{}{}] {} out of {} chunks checked, {} out of {} biomes found'.format('=' * progress, '.' * (4 - progress), i, len(chunks_by_distance), more_itertools.quantify(biome_info['found_chunk_distance'] is not None for biome_info in result.values()), len(result)), end='\r', flush=True)
-        if all(biome_result['found_chunk_distance'] is not None and chunk_distance > biome_result['found_chunk_distance'] + 3 for biome_result in result.values()):
-            break # if the chunk distance is 4 more than the last found, the block distance cannot be smaller
-        while True:
-            try:
-                chunk_data = api_json(arguments, '/v2/world/{{world}}/chunks/overworld/chunk/{}/0/{}.json'.format(chunk['x'], chunk['z']))
-            except requests.RequestException:
+    concurrency = int(arguments['--concurrency'])
+    world = get_world(arguments) # look up the world name once instead of for each chunk
+    pending = set(biomes) # biomes whose closest block may still be in a later chunk
+    found_count = 0
+    progress_stride = max(1, num_chunks // 200) # only update the progress line every 0.5% of chunks
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        downloads = collections.deque() # (chunk distance, chunk, distance to its closest block, future or None if skipped) for the chunks ahead of this one
+        num_downloading = 0
+        producing = True
+        for i in range(num_chunks):
+            while producing and num_downloading < concurrency: # keep the next few chunks downloading while this one is checked
+                next_chunk_distance, next_chunk = next(chunks_by_distance, (None, None))
+                if next_chunk is None:
+                    break
+                if not any(ring_could_improve(result[biome], next_chunk_distance) for biome in pending):
+                    # the search stops at this chunk at the latest, so don't take any further chunks from the generator
+                    downloads.append((next_chunk_distance, next_chunk, None, None))
+                    producing = False
+                    break
+                next_min_block_distance = chunk_block_distance(next_chunk, start_x, start_z)
+                if chunk_could_improve(result, pending, next_min_block_distance):
+                    downloads.append((next_chunk_distance, next_chunk, next_min_block_distance, executor.submit(chunk_blocks, arguments, world, next_chunk)))
+                    num_downloading += 1
+                else:
+                    downloads.append((next_chunk_distance, next_chunk, next_min_block_distance, None))
+            chunk_distance, chunk, min_block_distance, future = downloads[0]
+            if arguments['--verbose'] and i % progress_stride == 0:
+                progress = min(4, int(5 * i / num_chunks))
+                print('[{}{}] {} out of {} chunks checked, {} out of {} biomes found'.format('=' * progress, '.' * (4 - progress), i, num_chunks, found_count, len(result)), end='\r', flush=True)
+            pending = {
+                biome
+                for biome in pending
+                if ring_could_improve(result[biome], chunk_distance)
+            }
+            if not pending:
+                break
+            downloads.popleft()
+            if future is None:
+                continue # skipped without downloading since it couldn't contain a closer block
+            num_downloading -= 1
+            if not chunk_could_improve(result, pending, min_block_distance):
+                future.cancel() # a closer block was found after this chunk's download started
                 continue
-            break
-        for row in chunk_data[0]:
-            for block in row:
-                biome = Biome[block['biome']]
-                if biome in result:
-                    if result[biome]['found_chunk_distance'] is None or abs(block['x'] - start_x) + abs(block['z'] - start_z) < abs(result[biome]['x'] - start_x) + abs(result[biome]['z'] - start_z):
-                        result[biome] = {
-                            'found_chunk_distance': chunk_distance,
-                            'x': block['x'],
-                            'z': block['z']
-                        }
+            blocks = future.result()
+            for biome in pending & blocks.keys():
+                biome_result = result[biome]
+                if biome_result['found_chunk_distance'] is not None and min_block_distance >= biome_result['distance']:
+                    continue # no block in this chunk can be closer
+                block_distance, x, z = min((abs(x - start_x) + abs(z - start_z), x, z) for x, z in zip(*blocks[biome]))
+                if biome_result['found_chunk_distance'] is None or block_distance < biome_result['distance']:
+                    if biome_result['found_chunk_distance'] is None:
+                        found_count += 1
+                    result[biome] = {
+                        'distance': block_distance,
+                        'found_chunk_distance': chunk_distance,
+                        'x': x,
+                        'z': z
+                    }
+        for _, _, _, future in downloads:
+            if future is not None:
+                future.cancel()
     if arguments['--verbose']:
         print('[ ok ]')
     return result
 
+def get_biome_enum():
+    if CACHE['biomes'] is None:
+        response = SESSION.get('https://assets.wurstmineberg.de/json/biomes.json')
+        response.raise_for_status()
+        CACHE['biomes'] = enum.Enum('Biomes', {
+            biome_info['id']: (int(int_id), biome_info['adventuringTime'])
+            for int_id, biome_info in orjson.loads(response.content)['biomes'].items()
+        }, module=__name__)
+    return CACHE['biomes']
+
+def get_biomes_by_name():
+    if CACHE['biomes_by_name'] is None:
+        CACHE['biomes_by_name'] = {biome.name: biome for biome in get_biome_enum()}
+    return CACHE['biomes_by_name']
+
 def get_world(arguments):
     if arguments['--world']:
         return arguments['--world']
     if CACHE['world'] is None:
-        response = requests.get(arguments['--api-url'] + '/v2/server/worlds.json')
+        response = SESSION.get(arguments['--api-url'] + '/v2/server/worlds.json')
         response.raise_for_status()
-        CACHE['world'] = more_itertools.one(world_name for world_name, world_info in response.json().items() if world_info['main'])
+        CACHE['world'] = more_itertools.one(world_name for world_name, world_info in orjson.loads(response.content).items() if world_info['main'])
     return CACHE['world']
 
 if __name__ == '__main__':
     arguments = docopt.docopt(__doc__)
+    try:
+        concurrency = int(arguments['--concurrency'])
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        raise docopt.DocoptExit('--concurrency must be a positive integer')
+    SESSION.mount(arguments['--api-url'], requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)) # one keep-alive connection per download thread, shared with the other API requests
+    Biome = get_biome_enum()
     if arguments['adv-time']:
         biomes = [biome for biome in Biome if biome.value[1]]
-    if arguments['<biome>']:
+    elif arguments['<biome>']:
         biomes = [Biome[biome_str] for biome_str in arguments['<biome>']]
     else:
         biomes = list(Biome)
@@ -108,7 +256,7 @@ if __name__ == '__main__':
     else:
         if arguments['--verbose']:
             print('[....] downloading level.json', end='\r', flush=True)
-        level = api_json(arguments, '/v2/world/{world}/level.json')
+        level = api_json(arguments, get_world(arguments), '/v2/world/{world}/level.json')
         if arguments['--verbose']:
             print('[ ok ]')
         start_x = level['Data']['SpawnX']
@@ -117,8 +265,7 @@ if __name__ == '__main__':
             print('[ ** ] start coords: {},{}'.format(start_x, start_z))
     result = get_closest_coords(arguments, biomes, start_x, start_z)
     for biome in sorted(biomes, key=lambda biome: biome.value[0]):
-        if result[biome] is None:
+        if result[biome]['found_chunk_distance'] is None:
             print('[ !! ] {}: not found'.format(biome.name))
         else:
-            x, z = result
-            print('[ ** ] {}: {},{} ({} blocks from {},{})'.format(biome.name, x, z, abs(x - start_x) + abs(z - start_z), start_x, start_z))
+            print('[ ** ] {}: {},{} ({} blocks from {},{})'.format(biome.name, result[biome]['x'], result[biome]['z'], result[biome]['distance'], start_x, start_z))